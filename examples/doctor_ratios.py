@@ -25,8 +25,12 @@ datafile = osp.join(rootdir, 'data', 'dol_perm', 'perm.pkl')
 data = pd.read_pickle(datafile)
 
 # Compute percentages of immigrants with doctoral degree
-doctorate_ratio = data.groupby('job_state')['worker_education_level'].\
-    apply(lambda x: 100 * (x=='DOCTORATE').sum() / x.count())
+education = data['worker_education_level']
+counts = pd.DataFrame({
+    'doctorate': education.eq('DOCTORATE'),
+    'known': education.notna(),
+}).groupby(data['job_state'], observed=True).sum()
+doctorate_ratio = 100 * counts['doctorate'] / counts['known']
 
 # Check available years
 years = data.loc[data['worker_education_level'].notna(),'fiscal_year'].unique()
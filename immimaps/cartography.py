@@ -4,6 +4,8 @@ A simple demo map can be drawn by running this file as a module with
 `python -m immimaps.cartography`
 """
 
+import functools
+
 import cartopy.crs as ccrs
 import cartopy.io.shapereader as shapereader
 
@@ -15,8 +17,9 @@ import matplotlib.pyplot as plt
 from . import geography
 
 
+@functools.lru_cache(maxsize=4)
 def _get_reader(location):
-    """Get shapereader"""
+    """Get shapereader (cached)"""
     if location == 'us':
         shapefile = shapereader.natural_earth(
             resolution='110m',
@@ -36,6 +39,12 @@ def _get_reader(location):
     return reader
 
 
+@functools.lru_cache(maxsize=4)
+def _get_records(location):
+    """Get all shapefile records of a location (cached)"""
+    return tuple(_get_reader(location).records())
+
+
 def _add_inset(ax, axpos, record, color=(1, 1, 1), projection=ccrs.Mercator()):
     """Create an inset map with and draw geometry in it"""
     inset = ax.inset_axes(axpos, projection=projection)
@@ -86,31 +95,35 @@ def draw_us_map(statevals=None, *, fig=None,
     def abbrv_to_color(abbrv):
         return sm.to_rgba(statevals[abbrv]) if abbrv in statevals else defaultcolor
 
-    # Add 50 states and D.C.
-    reader = _get_reader('us')
-    for state in reader.records():
+    # Add 50 states and D.C.; mainland states are collected and drawn with a single call
+    states = _get_records('us')
+    mainland_colors = dict()
+    for state in states:
         abbrv = state.attributes['postal']
         color = abbrv_to_color(abbrv)
         if abbrv == 'AK':
             _add_inset(ax, alaska_extent_axes, state, color)
-        if abbrv == 'DC':
+        elif abbrv == 'DC':
             lon = state.attributes['longitude']
             lat = state.attributes['latitude']
             pos = ccrs.LambertConformal().transform_point(lon, lat, ccrs.PlateCarree())
             _add_tiny(ax, pos, tiny_radius_meters, color)
-        if abbrv == 'HI':
+        elif abbrv == 'HI':
             _add_inset(ax, hawaii_extent_axes, state, color)
         else:
-            ax.add_geometries([state.geometry], ccrs.PlateCarree(),
-                              edgecolor='none', facecolor=color)
+            mainland_colors[id(state.geometry)] = (state.geometry, color)
+
+    # Cartopy skips geometries outside of the view, so colors are looked up per geometry
+    ax.add_geometries([geom for geom, _ in mainland_colors.values()], ccrs.PlateCarree(),
+                      edgecolor='none',
+                      styler=lambda geom: {'facecolor': mainland_colors[id(geom)][1]})
 
     # Draw all boundaries at the same time for better quality
-    ax.add_geometries(reader.geometries(), ccrs.PlateCarree(),
+    ax.add_geometries([state.geometry for state in states], ccrs.PlateCarree(),
                       edgecolor='black', facecolor=(0, 0, 0, 0))
 
     # Add Puerto Rico
-    reader = _get_reader('world')
-    for country in reader.records():
+    for country in _get_records('world'):
         if country.attributes['NAME'] =='Puerto Rico':
             color = abbrv_to_color('PR')
             _add_inset(ax, puerto_rico_extent_axes, country, color)
@@ -121,9 +134,9 @@ def draw_us_map(statevals=None, *, fig=None,
     x0 = puerto_rico_extent_axes[0] + 0.5*puerto_rico_extent_axes[2] - \
         0.5*(len(territories)-1)*tiny_margin_axes
     y0 = puerto_rico_extent_axes[1] - tiny_margin_axes
-    for terr in territories:
-        datapos = ax.transData.inverted().transform(ax.transAxes.transform((x0, y0)))
-        x0 += tiny_margin_axes
+    axespos = [(x0 + i*tiny_margin_axes, y0) for i in range(len(territories))]
+    datapos_all = (ax.transAxes - ax.transData).transform(axespos)
+    for terr, datapos in zip(territories, datapos_all):
         color = abbrv_to_color(terr)
         _add_tiny(ax, datapos, tiny_radius_meters, color)
         ax.text(datapos[0], datapos[1]-tiny_radius_meters*1.5, terr, ha='center', va='top')
@@ -7,6 +7,10 @@ When this module is run as is with `python -m immimaps.preprocessing`, the full
 pipeline is applied to the files in the default data folder.
 """
 
+import concurrent.futures
+import glob
+import hashlib
+import importlib.util
 import os
 import re
 
@@ -14,6 +18,11 @@ import pandas as pd
 
 from . import geography
 
+# Calamine is much faster than openpyxl but it is supported by pandas 2.2 and newer only
+_HAS_CALAMINE = importlib.util.find_spec('python_calamine') is not None
+_PANDAS_VERSION = tuple(int(v) for v in pd.__version__.split('.')[:2])
+_EXCEL_ENGINE = 'calamine' if _HAS_CALAMINE and _PANDAS_VERSION >= (2, 2) else 'openpyxl'
+
 
 # Certification status column name and its canonicalized aliases in the raw data
 _STATUS_COLUMN = {'case_status': ['case_status']}
@@ -58,15 +67,42 @@ _DATA_COLUMNS = {
     'worker_education_country': ['foreign_worker_ed_inst_country'],
 }
 
+# All canonicalized column names in the raw data that are needed later on
+_RAW_COLUMNS = {col for k, v in (_STATUS_COLUMN | _DATA_COLUMNS).items() for col in [k, *v]}
+
+# Fingerprint of everything that defines a selected subset of a raw data file; increase the
+# version number whenever select_subset itself changes
+_SUBSET_VERSION = hashlib.sha1(
+    repr((1, _STATUS_COLUMN, _CERT_STATUSES, _DATA_COLUMNS)).encode()).hexdigest()
+
+# Pattern for extracting fiscal year from a filename
+_FY_RE = re.compile(r'FY(\d+)')
+
 # Non-standard aliases used by DoL for postal abbreviations
 _US_STATE_EXCEPTIONS = {'VI': ['Virgin Islands']}
 
+# Uppercase full names of U.S. states and territories and their postal abbreviations
+_NAME_TO_ABBRV = {long.upper(): short for short, long in geography.us_states().items()}
+_NAME_TO_ABBRV.update({long.upper(): short
+                       for short, longs in _US_STATE_EXCEPTIONS.items() for long in longs})
+
+# Pattern for extracting the full name at the beginning of an uppercase U.S. state entry;
+# the name must end at a word boundary ('INDIANAPOLIS' is not 'INDIANA'), and longest names
+# come first so that a name is never shadowed by its own prefix
+_US_STATE_RE = re.compile(
+    '^(' + '|'.join(re.escape(name) for name in sorted(_NAME_TO_ABBRV, key=len, reverse=True))
+    + r')(?=\s|$)')
+
 
 ### File input ###
 
+def _canonical_name(col):
+    """Canonicalize raw column name"""
+    return str(col).lower().replace(' ', '_')
+
 def fiscal_year_from_filename(filename):
     """Determine fiscal year from a filename"""
-    match = re.search(r'FY(\d+)', filename)
+    match = _FY_RE.search(filename)
     if match is None:
         return None
     fiscal_year = int(match[1])
@@ -74,17 +110,11 @@ def fiscal_year_from_filename(filename):
         fiscal_year += 2000
     return fiscal_year
 
-def read_xlsx(filename, cachedir=None):
-    """Read XLSX file contents and optionally use pickled cache."""
-    if cachedir is not None:
-        basename = os.path.basename(filename)
-        cachefile = os.path.join(cachedir, os.path.splitext(basename)[0] + '.bz2')
-        if os.path.isfile(cachefile):
-            data = pd.read_pickle(cachefile)
-            return data
-    data = pd.read_excel(filename) # slow
-    if cachedir is not None:
-        data.to_pickle(cachefile)
+def read_xlsx(filename):
+    """Read XLSX file contents"""
+    # Read only the relevant columns and all values as text to skip type inference
+    data = pd.read_excel(filename, engine=_EXCEL_ENGINE, dtype=str,
+                         usecols=lambda col: _canonical_name(col) in _RAW_COLUMNS) # slow
     return data
 
 
@@ -92,9 +122,11 @@ def read_xlsx(filename, cachedir=None):
 
 def canonical_columns(data, cols_with_aliases):
     """Rename and select columns using name canonicalization and de-aliasing"""
-    data = data.rename(columns=lambda col: col.lower().replace(' ', '_'))
-    data = data.rename(columns={alias: k for k, v in cols_with_aliases.items() for alias in v})
-    data = data[[col for col in data.columns if col in cols_with_aliases]]
+    aliases = {alias: k for k, v in cols_with_aliases.items() for alias in v}
+    names = pd.Index([aliases.get(name, name) for name in map(_canonical_name, data.columns)])
+    keep = names.isin(list(cols_with_aliases))
+    data = data.loc[:, keep]
+    data.columns = names[keep]
     return data
 
 def select_subset(data, fiscal_year):
@@ -115,63 +147,61 @@ def select_subset(data, fiscal_year):
 
 def remove_duplicates(data):
     """For duplicates, keep only the most recent entry (assume data is sorted by fiscal year)"""
-    data = data.drop_duplicates('case_number', keep='last')
+    data = data.groupby('case_number', sort=False, dropna=False).tail(1)
     # TODO: collect info about duplicate removal
     return data
 
 
 ### Value canonicalization ###
 
-def canonicalize_us_states(data, cols):
+def canonicalize_us_states(data, cols, collect_bad=False):
     """Convert U.S. state entries to uppercase postal abbreviations"""
-    states = geography.us_states()
-    states = {long: short for short, long in states.items()}
-    for short, longs in _US_STATE_EXCEPTIONS.items():
-        for long in longs:
-            states[long] = short
-
+    abbrvs = set(_NAME_TO_ABBRV.values())
     bad = dict()
     for col in cols:
-        orig = data[col].copy()
-        data[col] = data[col].astype('string').str.strip(' 1234567890')
-        for long, short in states.items():
-            data[col] = data[col].str.replace('^'+long, short, case=False, regex=True)
-        data[col] = data[col].str.split(n=1).str.get(0)
+        upper = data[col].astype('string').str.strip(' 1234567890').str.upper()
+        canonical = (upper
+                     .str.extract(_US_STATE_RE, expand=False)
+                     .map(_NAME_TO_ABBRV)
+                     .fillna(upper.str.split(n=1).str.get(0)))
+        canonical = canonical.where(canonical.isin(abbrvs))
 
-        not_canonicalized = ~data[col].isin(states.values())
-        data.loc[not_canonicalized,col] = None
-        bad[col] = orig[not_canonicalized].value_counts()
+        if collect_bad:
+            bad[col] = data.loc[canonical.isna(),col].value_counts()
+        data[col] = canonical
 
     return data, bad
 
-def canonicalize_postal_codes(data, cols):
+def canonicalize_postal_codes(data, cols, collect_bad=False):
     """Convert postal codes to strings of length five"""
     bad = dict()
     for col in cols:
-        orig = data[col].copy()
-        data[col] = (data[col]
+        canonical = (data[col]
                      .astype('string')
                      .str.extract(r'(\d{1,5})', expand=False)
                      .str.zfill(5))
-        not_canonicalized = data[col].isna() & ~orig.isna()
-        bad[col] = orig[not_canonicalized].value_counts()
+        if collect_bad:
+            bad[col] = data.loc[canonical.isna(),col].value_counts()
+        data[col] = canonical
     return data, bad
 
-def canonicalize_wages(data, cols):
+def canonicalize_wages(data, cols, collect_bad=False):
     """Convert wages to floats"""
     bad = dict()
     for col in cols:
-        orig = data[col].copy()
-        text = data[col].apply(type) == str
-        data.loc[text,col] = pd.to_numeric(
-            data.loc[text,col].str.replace(',', ''), errors='coerce')
+        wages = pd.to_numeric(data[col], errors='coerce')
+        text = wages.isna() & data[col].notna() # such as '1,234.00'
+        wages[text] = pd.to_numeric(
+            data.loc[text,col].astype(str).str.replace(',', '', regex=False),
+            errors='coerce').astype(float)
 
-        not_canonicalized = data[col].isna() & ~orig.isna()
-        bad[col] = orig[not_canonicalized].value_counts()
+        if collect_bad:
+            bad[col] = data.loc[wages.isna(),col].value_counts()
+        data[col] = wages
 
     return data, bad
 
-def canonicalize_unit_of_pay(data, cols):
+def canonicalize_unit_of_pay(data, cols, collect_bad=False):
     """Convert unit of pay to short standard form"""
     units = {
         'YEAR': 'YR',
@@ -181,33 +211,32 @@ def canonicalize_unit_of_pay(data, cols):
         'HOUR': 'HR'}
     bad = dict()
     for col in cols:
-        orig = data[col].copy()
-        data[col] = data[col].str.upper()
-        for long, short in units.items():
-            data[col] = data[col].str.replace('^'+long, short, case=False, regex=True)
+        upper = data[col].str.upper()
+        canonical = upper.map(units).fillna(upper)
+        canonical = canonical.where(canonical.isin(units.values()))
 
-        not_canonicalized = ~data[col].isin(units.values())
-        data.loc[not_canonicalized,col] = None
-        bad[col] = orig[not_canonicalized].value_counts()
+        if collect_bad:
+            bad[col] = data.loc[canonical.isna(),col].value_counts()
+        data[col] = canonical
 
     return data, bad
 
-def canonicalize_values(data):
-    """Try to canonicalize all values and their datatypes"""
+def canonicalize_values(data, collect_bad=False):
+    """Try to canonicalize all values and their datatypes, optionally counting bad values"""
     bad = dict()
 
     state_cols = [
         'employer_state',
         'job_state',
     ]
-    data, bad_ = canonicalize_us_states(data, state_cols)
+    data, bad_ = canonicalize_us_states(data, state_cols, collect_bad)
     bad |= bad_
 
     postal_cols = [
         'employer_postal_code',
         'job_postal_code',
     ]
-    data, bad_ = canonicalize_postal_codes(data, postal_cols)
+    data, bad_ = canonicalize_postal_codes(data, postal_cols, collect_bad)
     bad |= bad_
 
     wage_cols = [
@@ -215,14 +244,14 @@ def canonicalize_values(data):
         'job_wage_offer_to',
         'prevailing_wage',
     ]
-    data, bad_ = canonicalize_wages(data, wage_cols)
+    data, bad_ = canonicalize_wages(data, wage_cols, collect_bad)
     bad |= bad_
 
     unit_of_pay_cols = [
         'job_wage_offer_unit_of_pay',
         'prevailing_wage_unit_of_pay',
     ]
-    data, bad_ = canonicalize_unit_of_pay(data, unit_of_pay_cols)
+    data, bad_ = canonicalize_unit_of_pay(data, unit_of_pay_cols, collect_bad)
     bad |= bad_
 
     numeric_cols = [
@@ -238,16 +267,72 @@ def canonicalize_values(data):
     for col in numeric_cols:
         data[col] = pd.to_numeric(data[col], errors='coerce')
 
+    # Arrow-backed strings take less memory than Python objects and are uppercased in C
     for col in data.columns.difference(numeric_cols):
-        data[col] = data[col].astype('string').str.upper()
+        data[col] = data[col].astype('string[pyarrow]').str.upper()
+
+    categorical_cols = [
+        'employer_state',
+        'job_state',
+        'job_wage_offer_unit_of_pay',
+        'prevailing_wage_unit_of_pay',
+        'worker_education_level',
+        'worker_class_of_admission',
+    ]
+    for col in categorical_cols:
+        data[col] = data[col].astype('category')
 
     return data, bad
 
 
 ### Main entrypoint ###
 
-def preprocess_directory(input_dir, output_dir=None):
-    """Preprocess all raw data files in a directory and produce several new files"""
+def _preprocess_file(input_dir, ifile, fiscal_year, output_dir):
+    """Read a single raw data file and select its relevant subset (cached)"""
+    # The cache key changes whenever the raw data file or the subset definition is modified
+    path = os.path.join(input_dir, ifile)
+    key = '{}:{}:{}:{}'.format(ifile, os.path.getmtime(path), os.path.getsize(path),
+                               _SUBSET_VERSION)
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    basename = os.path.splitext(ifile)[0]
+    datafile = os.path.join(output_dir, 'perm_{}_{}.feather'.format(basename, key))
+    statsfile = os.path.join(output_dir, 'stats_{}_{}.pkl'.format(basename, key))
+    if os.path.isfile(datafile) and os.path.isfile(statsfile):
+        print('Reading subset of "{}"...'.format(basename))
+        data = pd.read_feather(datafile)
+        rowstats, colstats = pd.read_pickle(statsfile)
+        return data, rowstats, colstats
+
+    print('Reading "{}"...'.format(basename))
+    data = read_xlsx(path)
+
+    data, rowstats, colstats = select_subset(data, fiscal_year)
+    data = data.reset_index(drop=True)
+
+    # Remove outdated subsets of the same raw data file; the key matches exactly 16 hex digits
+    # so that subsets of other files whose names only start the same are not matched
+    anykey = '[0-9a-f]' * 16
+    for pattern in ('perm_{}_{}.feather', 'stats_{}_{}.pkl'):
+        pattern = os.path.join(glob.escape(output_dir), pattern.format(glob.escape(basename), anykey))
+        for outdated in glob.glob(pattern):
+            try:
+                os.remove(outdated)
+            except FileNotFoundError:
+                pass
+
+    data.to_feather(datafile)
+    pd.to_pickle((rowstats, colstats), statsfile)
+    return data, rowstats, colstats
+
+def preprocess_directory(input_dir, output_dir=None, max_workers=None):
+    """Preprocess all raw data files in a directory and produce several new files
+
+    The raw data files are read in parallel using at most `max_workers` processes (by default,
+    four or the number of processors if smaller). Each process holds a whole workbook in memory
+    while reading it, so peak memory grows with the number of processes.
+    """
+    if max_workers is None:
+        max_workers = min(4, os.cpu_count() or 1)
     if output_dir is None:
         output_dir = input_dir
     print('Input directory:', input_dir)
@@ -262,20 +347,23 @@ def preprocess_directory(input_dir, output_dir=None):
     # Actual data, simplified and canonicalized
     perm = [pd.DataFrame(columns=list(_DATA_COLUMNS.keys()))]
 
+    jobs = []
     for ifile in input_files:
         fiscal_year = fiscal_year_from_filename(ifile)
         if fiscal_year is None:
             print('Skipping "{}" because the filename does not contain fiscal year.'.format(ifile))
             continue
-
-        print('Reading "{}"...'.format(os.path.splitext(ifile)[0])) # reading xlsx or bz2
-        data = read_xlsx(os.path.join(input_dir, ifile), output_dir)
-
-        data, rowstats, colstats = select_subset(data, fiscal_year)
-
-        perm.append(data)
-        status_counts.append(rowstats)
-        avail_ratios.append(colstats)
+        jobs.append((ifile, fiscal_year))
+
+    # Files are independent of each other, so they are read in separate processes
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(_preprocess_file, input_dir, ifile, fiscal_year, output_dir)
+                   for ifile, fiscal_year in jobs]
+        for future in futures:
+            data, rowstats, colstats = future.result()
+            perm.append(data)
+            status_counts.append(rowstats)
+            avail_ratios.append(colstats)
 
     print('Normalizing data and writing output files...')
 
@@ -289,8 +377,8 @@ def preprocess_directory(input_dir, output_dir=None):
     avail_ratios.to_pickle(os.path.join(output_dir, 'availability.pkl'))
     avail_ratios.to_csv(os.path.join(output_dir, 'availability.csv'))
 
-    # Sort data, remove duplicates and canonicalize values
-    perm = pd.concat(perm).sort_values(['case_number', 'fiscal_year'])
+    # Sort data by year, remove duplicates and canonicalize values
+    perm = pd.concat(perm, ignore_index=True).sort_values('fiscal_year', kind='mergesort')
     perm = remove_duplicates(perm)
     perm = perm.set_index('case_number')
     perm, bad = canonicalize_values(perm)
@@ -298,7 +386,8 @@ def preprocess_directory(input_dir, output_dir=None):
 
     # Availability after value canonicalization; this does not distinguish
     # between missing columns and columns that have zero entries
-    avail_ratios1 = perm.groupby('fiscal_year').apply(lambda x: x.count() / x.shape[0])
+    perm_by_year = perm.groupby('fiscal_year')
+    avail_ratios1 = perm_by_year.count().div(perm_by_year.size(), axis=0)
     avail_ratios1.to_pickle(os.path.join(output_dir, 'availability1.pkl'))
     avail_ratios1.to_csv(os.path.join(output_dir, 'availability1.csv'))
 